@@ -1,29 +1,102 @@
 import sqlite3
 import json
-import uuid
+import secrets
+import threading
 import time
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
+
+from elo import Elo
 
 DB_FILE = "risiko.db"
 
+# Explicit column order for player queries, so plain tuples can be zipped into dicts
+# without going through sqlite3.Row
+_PLAYER_COLS = ("id", "name", "rating", "games_played", "created_at")
+
+# Leaderboard order within a group: rating DESC, then oldest player first, then id.
+# _SORTS_BEFORE is the same order as a SQL predicate (params: rating, rating, created_at, created_at, id)
+_SORTS_BEFORE = """(rating > ? OR (rating = ? AND (COALESCE(created_at, 0) < ?
+                     OR (COALESCE(created_at, 0) = ? AND id < ?))))"""
+
+def _leaderboard_key(p: Dict[str, Any]):
+    return (-p['rating'], p['created_at'] or 0, p['id'])
+
+def _gen_id() -> str:
+    # 32 hex chars straight from os.urandom, no UUID object/formatting
+    return secrets.token_hex(16)
+
 class Database:
     def __init__(self):
-        self.conn = None
-
-    def connect(self):
-        self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        # One connection per thread, opened lazily by _conn() and never handed to another
+        # thread (sqlite3's default check_same_thread enforces it): no connection or half-done
+        # transaction is shared between concurrent requests. WAL lets readers and the writer
+        # run side by side. With a fixed pool of worker threads (e.g. gunicorn gthread) each
+        # connection stays warm; a thread-per-request server opens one per request thread.
+        self._local = threading.local()
+        # In-process caches, dropped by every write (see _invalidate_cache).
+        # Assumes a single process owns the db: another worker's writes won't invalidate these.
+        self._leaderboard_cache = None
+        self._k_factor_cache = None
+        # Bumped on every invalidation; a read only fills the cache if no write happened meanwhile
+        self._cache_gen = 0
+        self._cache_lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(DB_FILE, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+
+        # WAL + synchronous=NORMAL: one append per commit instead of two fsyncs
+        cursor = conn.cursor()
+        for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY",
+                       "mmap_size=268435456", "cache_size=-20000", "foreign_keys=ON"):
+            cursor.execute(f"PRAGMA {pragma}")
+        return conn
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    def end_request(self):
+        """
+        End-of-request hook: rolls back anything the request left uncommitted on this
+        thread's connection. The connection itself stays with the thread.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
+    @staticmethod
+    def _begin(cursor: sqlite3.Cursor):
+        # A transaction still open here means some code path forgot to commit/rollback:
+        # fail loudly instead of silently discarding (or nesting into) its writes
+        if cursor.connection.in_transaction:
+            raise sqlite3.OperationalError("A transaction is already open on this connection")
+        cursor.execute("BEGIN IMMEDIATE")
+
+    def _invalidate_cache(self):
+        with self._cache_lock:
+            self._cache_gen += 1
+            self._leaderboard_cache = None
+            self._k_factor_cache = None
+
+    def _store_cache(self, attr: str, value, gen: int):
+        # Skip storing if a write invalidated the cache after this read's snapshot was taken
+        with self._cache_lock:
+            if self._cache_gen == gen:
+                setattr(self, attr, value)
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        # Closes the calling thread's connection; other threads' ones go away with their thread
+        conn = getattr(self._local, 'conn', None)
+        if conn:
+            conn.close()
+            self._local.conn = None
 
     def init_db(self):
-        self.connect()
-        cursor = self.conn.cursor()
-        
-        # Enable Foreign Keys
-        cursor.execute("PRAGMA foreign_keys = ON;")
+        conn = self._conn()
+        cursor = conn.cursor()
 
         # Players
         cursor.execute("""
@@ -71,116 +144,223 @@ class Database:
             )
         """)
 
+        # Indexes
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_players_ranking ON players(games_played, rating DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_matches_winner ON matches(winner_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_matches_date ON matches(date DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_parts_player ON participations(player_id)")
+        # (match_id, is_winner) also serves plain match_id lookups
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_parts_match_winner ON participations(match_id, is_winner)")
+
         # Insert Default K-Factor if not exists
         cursor.execute("INSERT OR IGNORE INTO system_settings (key, value) VALUES (?, ?)", ("k_factor", "32"))
 
-        self.conn.commit()
+        conn.commit()
+
+        # Planner statistics, refreshed at every start. analysis_limit makes ANALYZE sample at
+        # most ~400 rows per index, so the cost stays bounded as the data grows.
+        # SQLite >= 3.46 can do it via PRAGMA optimize (0x10000: check every table, not only
+        # those this connection already queried - at startup that is none); older versions
+        # lack that bit, there a plain (bounded) ANALYZE is the only way to get fresh stats.
+        cursor.execute("PRAGMA analysis_limit=400")
+        if sqlite3.sqlite_version_info >= (3, 46):
+            cursor.execute("PRAGMA optimize=0x10002")
+        else:
+            cursor.execute("ANALYZE")
     
     # --- Settings ---
     def get_k_factor(self) -> float:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT value FROM system_settings WHERE key = 'k_factor'")
-        row = cursor.fetchone()
-        return float(row['value']) if row else 32.0
+        if self._k_factor_cache is not None:
+            return self._k_factor_cache
+        gen = self._cache_gen
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM system_settings WHERE key = 'k_factor'").fetchone()
+        k = float(row['value']) if row else 32.0
+        self._store_cache('_k_factor_cache', k, gen)
+        return k
 
     def set_k_factor(self, k: float):
-        cursor = self.conn.cursor()
-        cursor.execute("REPLACE INTO system_settings (key, value) VALUES ('k_factor', ?)", (str(k),))
-        self.conn.commit()
+        conn = self._conn()
+        conn.execute("REPLACE INTO system_settings (key, value) VALUES ('k_factor', ?)", (str(k),))
+        conn.commit()
+        self._invalidate_cache()
 
     # --- Players ---
     def create_player(self, name: str) -> str:
-        new_id = str(uuid.uuid4())
+        new_id = _gen_id()
+        conn = self._conn()
         try:
-            cursor = self.conn.cursor()
-            cursor.execute("INSERT INTO players (id, name, created_at) VALUES (?, ?, ?)", 
-                           (new_id, name, time.time()))
-            self.conn.commit()
+            conn.execute("INSERT INTO players (id, name, created_at) VALUES (?, ?, ?)", 
+                         (new_id, name, time.time()))
+            conn.commit()
+            self._invalidate_cache()
             return new_id
         except sqlite3.IntegrityError:
+            conn.rollback()
             raise ValueError("Player name already exists")
 
     def delete_player(self, player_id: str):
         """
         Deletes a player and cleans up associated data (matches won, participations).
         """
+        conn = self._conn()
+        cursor = conn.cursor()
+        self._begin(cursor)
         try:
-            cursor = self.conn.cursor()
-            
-            # 1. Get matches won by this player to delete them entirely
-            cursor.execute("SELECT id FROM matches WHERE winner_id = ?", (player_id,))
-            matches_won = [row['id'] for row in cursor.fetchall()]
-            
-            # 2. Delete participations for matches won by this player (everyone else's record in those matches)
-            for mid in matches_won:
-                cursor.execute("DELETE FROM participations WHERE match_id = ?", (mid,))
-            
-            # 3. Delete the matches won by this player
+        
+            # 1. Delete participations for matches won by this player (everyone else's record in those matches)
+            cursor.execute("DELETE FROM participations WHERE match_id IN (SELECT id FROM matches WHERE winner_id = ?)",
+                           (player_id,))
+        
+            # 2. Delete the matches won by this player
             cursor.execute("DELETE FROM matches WHERE winner_id = ?", (player_id,))
 
-            # 4. Delete participations of this player (where they lost)
+            # 3. Delete participations of this player (where they lost)
             cursor.execute("DELETE FROM participations WHERE player_id = ?", (player_id,))
 
-            # 5. Delete the player
+            # 4. Delete the player
             cursor.execute("DELETE FROM players WHERE id = ?", (player_id,))
-            
-            self.conn.commit()
+        
+            conn.commit()
+            self._invalidate_cache()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             raise e
 
     def delete_match(self, match_id: str):
         """
         Deletes a match and reverts the rating changes for all involved players.
         """
+        conn = self._conn()
+        cursor = conn.cursor()
+        self._begin(cursor)
         try:
-            cursor = self.conn.cursor()
-            
-            # 1. Get participations to know what to reverse
-            cursor.execute("SELECT player_id, rating_delta FROM participations WHERE match_id = ?", (match_id,))
-            parts = cursor.fetchall()
-            
-            if not parts:
+        
+            # 1. Check there is something to reverse
+            cursor.execute("SELECT COUNT(*) FROM participations WHERE match_id = ?", (match_id,))
+            if cursor.fetchone()[0] == 0:
                 raise ValueError("Match not found")
 
-            # 2. Reverse ratings
-            for p in parts:
-                # Subtract the delta to revert. Decrease games_played.
-                cursor.execute("UPDATE players SET rating = rating - ?, games_played = games_played - 1 WHERE id = ?", 
-                               (p['rating_delta'], p['player_id']))
+            # 2. Reverse ratings in one statement: subtract the delta(s), decrease games_played
+            cursor.execute("""
+                UPDATE players SET
+                    rating = rating - (SELECT SUM(rating_delta) FROM participations
+                                       WHERE match_id = ? AND player_id = players.id),
+                    games_played = games_played - (SELECT COUNT(*) FROM participations
+                                                   WHERE match_id = ? AND player_id = players.id)
+                WHERE id IN (SELECT player_id FROM participations WHERE match_id = ?)
+            """, (match_id, match_id, match_id))
 
             # 3. Delete from participations
             cursor.execute("DELETE FROM participations WHERE match_id = ?", (match_id,))
-            
+        
             # 4. Delete from matches
             cursor.execute("DELETE FROM matches WHERE id = ?", (match_id,))
-            
-            self.conn.commit()
+        
+            conn.commit()
+            self._invalidate_cache()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             raise e
 
     def get_player(self, player_id: str) -> Optional[Dict[str, Any]]:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM players WHERE id = ?", (player_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        conn = self._conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        row = cursor.execute("SELECT id, name, rating, games_played, created_at FROM players WHERE id = ?",
+                             (player_id,)).fetchone()
+        return dict(zip(_PLAYER_COLS, row)) if row else None
+
+    def get_players_by_ids(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Fetches several players with a single query. Returns a dict keyed by player id;
+        ids that don't exist are simply missing from the result.
+        """
+        if not ids:
+            return {}
+        placeholders = ",".join("?" * len(ids))
+        conn = self._conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(f"SELECT id, name, rating, games_played, created_at FROM players WHERE id IN ({placeholders})",
+                              list(ids)).fetchall()
+        return {row[0]: dict(zip(_PLAYER_COLS, row)) for row in rows}
     
+    @staticmethod
+    def _ranking_threshold(max_games: int) -> int:
+        # Logic: At least 5 games. At least 20% of leader. Cap at 15 games.
+        # MIN(15, MAX(5, max_games * 0.20))
+        calculated_threshold = max(5, int(max_games * 0.20))
+        return min(15, calculated_threshold)
+
+    def get_rank(self, player_id: str) -> Optional[int]:
+        """
+        Position of the player in the leaderboard (ranked players first, then provisional,
+        both by rating DESC, ties by creation time), counted in SQL instead of building the whole leaderboard.
+        """
+        conn = self._conn()
+        row = conn.execute("""
+            SELECT id, rating, games_played, COALESCE(created_at, 0) AS created_at,
+                   (SELECT MAX(games_played) FROM players) AS max_games
+            FROM players WHERE id = ?
+        """, (player_id,)).fetchone()
+        if not row:
+            return None
+
+        threshold = self._ranking_threshold(row['max_games'])
+        ahead = (row['rating'], row['rating'], row['created_at'], row['created_at'], row['id'])
+        if row['games_played'] >= threshold:
+            # Ranked: only ranked players sorting before this one are ahead
+            row = conn.execute(f"""
+                SELECT 1 + COUNT(*) FROM players
+                WHERE games_played >= ? AND {_SORTS_BEFORE}
+            """, (threshold, *ahead)).fetchone()
+        else:
+            # Provisional: every ranked player is ahead, plus provisional ones sorting before
+            row = conn.execute(f"""
+                SELECT 1 + COUNT(*) FROM players
+                WHERE games_played >= ? OR (games_played < ? AND {_SORTS_BEFORE})
+            """, (threshold, threshold, *ahead)).fetchone()
+        return row[0]
+
+    def get_player_stats(self, player_id: str) -> Dict[str, Any]:
+        """
+        Aggregates over the player's participations: games, wins, max/min rating reached.
+        """
+        conn = self._conn()
+        row = conn.execute("""
+            SELECT 
+                COUNT(*) AS games,
+                COALESCE(SUM(is_winner), 0) AS wins,
+                MAX(rating_after) AS max_rating,
+                MIN(rating_after) AS min_rating
+            FROM participations
+            WHERE player_id = ?
+        """, (player_id,)).fetchone()
+        return dict(row)
+
     def get_all_players(self) -> List[Dict[str, Any]]:
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM players")
-        players = [dict(row) for row in cursor.fetchall()]
+        if self._leaderboard_cache is not None:
+            return self._leaderboard_cache
+        gen = self._cache_gen
+
+        conn = self._conn()
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        # max_games rides along as a trailing column; zip() stops at _PLAYER_COLS and drops it
+        rows = cursor.execute("""
+            SELECT id, name, rating, games_played, created_at,
+                   (SELECT MAX(games_played) FROM players) AS max_games
+            FROM players
+        """).fetchall()
+        players = [dict(zip(_PLAYER_COLS, r)) for r in rows]
 
         if not players:
             return []
 
         # 1. Calculate Dynamic Threshold
-        max_games = max(p['games_played'] for p in players) if players else 0
-        
-        # Logic: At least 5 games. At least 20% of leader. Cap at 15 games.
-        # MIN(15, MAX(5, max_games * 0.20))
-        calculated_threshold = max(5, int(max_games * 0.20))
-        threshold = min(15, calculated_threshold)
+        max_games = rows[0][-1]
+        threshold = self._ranking_threshold(max_games)
 
         # 2. Separate Ranked vs Provisional
         ranked = []
@@ -196,69 +376,76 @@ class Database:
                 provisional.append(p)
 
         # 3. Sort
-        # Ranked: By Rating DESC
-        ranked.sort(key=lambda x: x['rating'], reverse=True)
+        # Ranked: By Rating DESC (ties: oldest player first, same order get_rank counts in)
+        ranked.sort(key=_leaderboard_key)
         
         # Provisional: By Rating DESC too (or games played? Usually rating is fine, just separated)
         # Let's sort provisional by Rating too so they see where they "would" be
-        provisional.sort(key=lambda x: x['rating'], reverse=True)
+        provisional.sort(key=_leaderboard_key)
 
-        return ranked + provisional
+        leaderboard = ranked + provisional
+        self._store_cache('_leaderboard_cache', leaderboard, gen)
+        return leaderboard
 
     # --- Matches ---
-    def record_match(self, date: str, winner_id: str, loser_ids: List[str], winner_delta: float, winner_new_rating: float, losers_data: List[Dict]):
+    def record_match(self, date: str, winner_id: str, loser_ids: List[str], k_factor: float) -> Tuple[str, float, List[float]]:
         """
-        losers_data: List of dicts {id, delta, new_rating, old_rating}
-        Transactional.
+        Records a match and applies the Elo changes.
+        Ratings are re-read inside the write transaction (BEGIN IMMEDIATE holds the write lock),
+        so concurrent submissions can't compute from, and overwrite, each other's stale ratings.
+        Returns (match_id, winner_delta, loser_deltas).
         """
-        match_id = str(uuid.uuid4())
-        k_used = self.get_k_factor()
+        match_id = _gen_id()
         
+        conn = self._conn()
+        cursor = conn.cursor()
+        self._begin(cursor)
         try:
-            cursor = self.conn.cursor()
-            
-            # 1. Create Match
+
+            # 1. Current ratings, under the write lock
+            ids = [winner_id] + list(loser_ids)
+            placeholders = ",".join("?" * len(ids))
+            ratings = {row['id']: row['rating'] for row in
+                       cursor.execute(f"SELECT id, rating FROM players WHERE id IN ({placeholders})", ids)}
+            missing = [pid for pid in ids if pid not in ratings]
+            if missing:
+                raise ValueError(f"Player {missing[0]} not found")
+
+            winner_old_rating = ratings[winner_id]
+            loser_old_ratings = [ratings[lid] for lid in loser_ids]
+            winner_delta, loser_deltas = Elo.calculate_deltas(winner_old_rating, loser_old_ratings, k_factor)
+            winner_new_rating = winner_old_rating + winner_delta
+
+            updates = [(winner_new_rating, winner_id)]
+            updates += [(old + d, lid) for lid, old, d in zip(loser_ids, loser_old_ratings, loser_deltas)]
+
+            parts_rows = [(_gen_id(), match_id, winner_id, 1, winner_old_rating, winner_new_rating, winner_delta)]
+            parts_rows += [(_gen_id(), match_id, lid, 0, old, old + d, d)
+                           for lid, old, d in zip(loser_ids, loser_old_ratings, loser_deltas)]
+        
+            # 2. Create Match
             cursor.execute("INSERT INTO matches (id, date, k_factor_used, winner_id, created_at) VALUES (?, ?, ?, ?, ?)",
-                           (match_id, date, k_used, winner_id, time.time()))
+                           (match_id, date, k_factor, winner_id, time.time()))
 
-            # 2. Update Winner
-            # Get old rating first (though we likely passed it in, let's trust the calc matches the db state if concurrency wasn't an issue. 
-            # Ideally we lock or re-read, but for this simple app we assume single-threaded logic in server.py calls this)
-            
-            winner_old_rating = winner_new_rating - winner_delta # Reverse just to store 'before' snapshot correctly
-            
-            cursor.execute("UPDATE players SET rating = ?, games_played = games_played + 1 WHERE id = ?", 
-                           (winner_new_rating, winner_id))
-            
-            cursor.execute("""
+            # 3. Update ratings of Winner + Losers
+            cursor.executemany("UPDATE players SET rating = ?, games_played = games_played + 1 WHERE id = ?", updates)
+
+            # 4. Store participations
+            cursor.executemany("""
                 INSERT INTO participations (id, match_id, player_id, is_winner, rating_before, rating_after, rating_delta)
-                VALUES (?, ?, ?, 1, ?, ?, ?)
-            """, (str(uuid.uuid4()), match_id, winner_id, winner_old_rating, winner_new_rating, winner_delta))
-
-            # 3. Update Losers
-            for l_data in losers_data:
-                pid = l_data['id']
-                delta = l_data['delta']
-                new_r = l_data['new_rating']
-                old_r = l_data['old_rating']
-                
-                cursor.execute("UPDATE players SET rating = ?, games_played = games_played + 1 WHERE id = ?", 
-                               (new_r, pid))
-                
-                cursor.execute("""
-                    INSERT INTO participations (id, match_id, player_id, is_winner, rating_before, rating_after, rating_delta)
-                    VALUES (?, ?, ?, 0, ?, ?, ?)
-                """, (str(uuid.uuid4()), match_id, pid, old_r, new_r, delta))
-
-            self.conn.commit()
-            return match_id
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, parts_rows)
+
+            conn.commit()
+            self._invalidate_cache()
+            return match_id, winner_delta, loser_deltas
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             raise e
-            
+        
     def get_player_history(self, player_id: str) -> List[Dict]:
-        cursor = self.conn.cursor()
-        cursor.execute("""
+        conn = self._conn()
+        rows = conn.execute("""
             SELECT 
                 p.match_id, 
                 m.date, 
@@ -269,24 +456,29 @@ class Database:
             JOIN matches m ON p.match_id = m.id
             WHERE p.player_id = ?
             ORDER BY m.date DESC
-        """, (player_id,))
-        return [dict(row) for row in cursor.fetchall()]
+        """, (player_id,)).fetchall()
+        return [dict(row) for row in rows]
 
     def get_matches_history(self) -> List[Dict]:
-        cursor = self.conn.cursor()
-        # Get Match + Winner + Losers concatenated
-        cursor.execute("""
+        # Get Match + Winner + Losers as a JSON array
+        conn = self._conn()
+        rows = conn.execute("""
             SELECT 
                 m.id, 
                 m.date, 
                 w.name as winner_name,
-                GROUP_CONCAT(l.name, ', ') as losers_names
+                json_group_array(l.name) as losers_json
             FROM matches m
             JOIN players w ON m.winner_id = w.id
             JOIN participations p ON p.match_id = m.id AND p.is_winner = 0
             JOIN players l ON p.player_id = l.id
             GROUP BY m.id
             ORDER BY m.date DESC
-        """)
-        return [dict(row) for row in cursor.fetchall()]
+        """).fetchall()
+        matches = []
+        for r in rows:
+            row = dict(r)
+            row['losers'] = json.loads(row.pop('losers_json'))
+            matches.append(row)
+        return matches
 
@@ -32,26 +32,12 @@ class Elo:
             - Winner's rating delta (float)
             - List of losers' rating deltas (List[float]), in same order as input.
         """
-        winner_delta = 0.0
-        loser_deltas = []
+        # Winner vs each Loser: the winner actually won (score 1).
+        # Delta = K * (1 - Expected)
+        win_deltas = [k_factor * (1.0 - Elo.expected_score(winner_rating, l_rating)) for l_rating in loser_ratings]
 
-        # Calculate Winner vs Each Loser
-        for l_rating in loser_ratings:
-            # Expected score for Winner vs this Loser
-            exp_win = Elo.expected_score(winner_rating, l_rating)
-            
-            # Winner actually won (score 1)
-            # Delta = K * (Actual - Expected)
-            single_match_win_delta = k_factor * (1.0 - exp_win)
-            winner_delta += single_match_win_delta
+        # Reverse for Loser: E(Loser, Winner) = 1 - E(Winner, Loser), so the loser's
+        # Delta = K * (0 - (1 - exp_win)) is exactly the opposite of the winner's. One pow per loser.
+        loser_deltas = [-d for d in win_deltas]
 
-            # Reverse for Loser
-            # Expected score for Loser vs Winner
-            exp_loss = Elo.expected_score(l_rating, winner_rating)
-            
-            # Loser actually lost (score 0)
-            # Delta = K * (0 - Expected)
-            single_match_loss_delta = k_factor * (0.0 - exp_loss)
-            loser_deltas.append(single_match_loss_delta)
-            
-        return winner_delta, loser_deltas
+        return sum(win_deltas), loser_deltas
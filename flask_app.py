@@ -1,28 +1,69 @@
 from flask import Flask, request, jsonify, send_from_directory
+import gzip
+import itertools
+import mimetypes
 import os
+import shutil
 import sys
+try:
+    import orjson
+except ImportError:  # orjson è opzionale: senza, si ricade su jsonify
+    orjson = None
 # Impostiamo la cartella corretta
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 from db import Database
-from elo import Elo
-# MODIFICA IMPORTANTE: static_folder='.' dice a Flask di cercare i file qui
-app = Flask(__name__, static_url_path='', static_folder='.')
+# static_folder=None: niente rotta statica di Flask, i file (qui nella cartella) li serve serve_static,
+# altrimenti la rotta 'static' intercetterebbe /style.css ecc. prima di noi
+app = Flask(__name__, static_folder=None)
 ADMIN_SECRET = "supersecret"
 db = Database()
 db.init_db()
+# A fine richiesta non deve restare nessuna transazione aperta sulla connessione del thread
+@app.teardown_appcontext
+def end_db_request(exc):
+    db.end_request()
 # --- Rotte File Statici ---
+COMPRESSIBLE = ('.js', '.css', '.html')
+# Pre-comprimiamo gli asset all'avvio (solo se il .gz manca o è più vecchio).
+# Su una cartella in sola lettura si salta: send_static serve comunque l'originale.
+for name in os.listdir('.'):
+    if name.endswith(COMPRESSIBLE) and (not os.path.exists(name + '.gz')
+                                        or os.path.getmtime(name + '.gz') < os.path.getmtime(name)):
+        try:
+            with open(name, 'rb') as src, gzip.open(name + '.gz.tmp', 'wb', compresslevel=9) as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(name + '.gz.tmp', name + '.gz')
+        except OSError:
+            pass
+def send_static(path):
+    if not path.endswith(COMPRESSIBLE):
+        return send_from_directory('.', path)
+    if os.path.exists(path + '.gz') and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        resp = send_from_directory('.', path + '.gz', mimetype=mimetypes.guess_type(path)[0])
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = send_from_directory('.', path)
+    # Nessun asset ha un hash nel nome: il browser li tiene in cache ma li rivalida
+    # ogni volta con l'ETag (304 se non sono cambiati), così un deploy si vede subito
+    resp.cache_control.no_cache = True
+    resp.headers['Vary'] = 'Accept-Encoding'
+    return resp
 @app.route('/')
 def serve_index():
-    return send_from_directory('.', 'index.html')
+    return send_static('index.html')
 # Questa regola serve tutto: .css, .js, .html
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('.', path)
+    return send_static(path)
 # --- API ---
+def ojson(obj, status=200):
+    if orjson is None:
+        return jsonify(obj), status
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
 @app.route('/api/leaderboard', methods=['GET'])
 def get_leaderboard():
     try:
-        return jsonify(db.get_all_players())
+        return ojson(db.get_all_players())
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 @app.route('/api/player/<id>', methods=['GET'])
@@ -32,11 +73,11 @@ def get_player(id):
         if not player: return jsonify({"error": "Not found"}), 404
         history = db.get_player_history(id)
 
-        all_players = db.get_all_players()
-        rank = next((i + 1 for i, p in enumerate(all_players) if p['id'] == id), "-")
+        rank = db.get_rank(id) or "-"
+        agg = db.get_player_stats(id)
 
-        total_games = len(history)
-        wins = sum(1 for match in history if match['is_winner'] == 1)
+        total_games = agg['games']
+        wins = agg['wins']
         win_rate = (wins / total_games * 100) if total_games > 0 else 0
 
         streak_count = 0
@@ -44,35 +85,30 @@ def get_player(id):
         if history:
             first_match_win = (history[0]['is_winner'] == 1)
             streak_type = "win" if first_match_win else "loss"
-            for match in history:
-                is_win = (match['is_winner'] == 1)
-                if (streak_type == "win" and is_win) or (streak_type == "loss" and not is_win):
-                    streak_count += 1
-                else: break
+            streak_count = sum(1 for _ in itertools.takewhile(
+                lambda m, f=first_match_win: (m['is_winner'] == 1) == f, history))
 
         current_rating = player['rating']
         max_rating = current_rating
         min_rating = current_rating
         if history:
-            all_ratings = [m['rating_after'] for m in history]
             oldest_match = history[-1]
             initial_rating = oldest_match['rating_after'] - oldest_match['rating_delta']
-            all_ratings.append(initial_rating)
-            max_rating = max(all_ratings)
-            min_rating = min(all_ratings)
+            max_rating = max(agg['max_rating'], initial_rating)
+            min_rating = min(agg['min_rating'], initial_rating)
         stats = {
             "rank": rank, "wins": wins, "win_rate": round(win_rate, 1),
             "streak_type": streak_type, "streak_count": streak_count,
             "max_rating": round(max_rating, 1), "min_rating": round(min_rating, 1)
         }
 
-        return jsonify({"player": player, "history": history, "stats": stats})
+        return ojson({"player": player, "history": history, "stats": stats})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 @app.route('/api/matches', methods=['GET'])
 def get_matches():
     try:
-        return jsonify(db.get_matches_history())
+        return ojson(db.get_matches_history())
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 @app.route('/api/settings', methods=['GET', 'POST'])
@@ -122,32 +158,15 @@ def create_match():
         return jsonify({"error": "Missing fields"}), 400
 
     try:
-        winner = db.get_player(winner_id)
-        if not winner: return jsonify({"error": "Winner not found"}), 404
+        found = db.get_players_by_ids([winner_id] + loser_ids)
+        if winner_id not in found: return jsonify({"error": "Winner not found"}), 404
 
-        losers = []
         for lid in loser_ids:
-            l = db.get_player(lid)
-            if not l: return jsonify({"error": f"Loser {lid} not found"}), 404
-            losers.append(l)
+            if lid not in found: return jsonify({"error": f"Loser {lid} not found"}), 404
 
-        winner_rating = winner['rating']
-        loser_ratings = [l['rating'] for l in losers]
+        # Le variazioni Elo si calcolano dentro la transazione, sui rating correnti
         k = db.get_k_factor()
-        delta_w, deltas_l = Elo.calculate_deltas(winner_rating, loser_ratings, k)
-
-        winner_new = winner_rating + delta_w
-        losers_update_data = []
-        for i, l_player in enumerate(losers):
-            d = deltas_l[i]
-            losers_update_data.append({
-                "id": l_player['id'],
-                "delta": d,
-                "new_rating": l_player['rating'] + d,
-                "old_rating": l_player['rating']
-            })
-
-        match_id = db.record_match(date, winner_id, loser_ids, delta_w, winner_new, losers_update_data)
+        match_id, delta_w, deltas_l = db.record_match(date, winner_id, loser_ids, k)
         return jsonify({"match_id": match_id, "deltas": {"winner": delta_w, "losers": deltas_l}})
 
     except Exception as e: